@@ -28,10 +28,25 @@ Output: consolidated shopping list as JSON.
 """
 
 import argparse
+import itertools
 import json
 import re
 import sys
-from collections import defaultdict
+from collections.abc import Iterable
+from operator import itemgetter
+from typing import BinaryIO
+
+# Optional: faster decoding of large recipe files (see _loads).
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ijson stream-parses recipe files so only one recipe is held in memory at a time.
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 # Pantry staples: items you likely already have. Buy once regardless of recipe count.
 PANTRY_STAPLES = {
@@ -73,6 +88,8 @@ PANTRY_STAPLES = {
     "mustard",
     "dijon mustard",
 }
+# Interned so lookups with interned normalized names hit the identity fast path
+PANTRY_STAPLES = frozenset(map(sys.intern, PANTRY_STAPLES))
 
 # Unit normalization map
 UNIT_ALIASES = {
@@ -134,6 +151,7 @@ UNIT_ALIASES = {
     "drizzle": "drizzle",
     "splash": "splash",
 }
+UNIT_ALIASES = {sys.intern(k): sys.intern(v) for k, v in UNIT_ALIASES.items()}
 
 # Units that can be summed (same dimension)
 SUMMABLE_UNITS = {
@@ -148,98 +166,111 @@ UNIT_CONVERSIONS = {
     "l": ("ml", 1000),
 }
 
+# Display rescaling for large base quantities: base unit -> (display unit, factor)
+DISPLAY_RESCALE = {
+    "g": ("kg", 1000),
+    "ml": ("l", 1000),
+}
+
+# Precompiled patterns for the per-line / per-ingredient hot paths
+_LIST_MARKER = re.compile(r"^(?:[\-\*\u2022]\s*|\d+[.)]\s+)")
+_ARTICLES = ("a ", "an ", "the ", "some ")
+_ARTICLE = re.compile(r"^(a |an |the |some )")
+_PAREN_TAIL = re.compile(r"\s*\(.*?\)\s*$")
+
 
 def normalize_unit(unit: str) -> str:
     """Normalize a unit string to a canonical form."""
-    unit = unit.strip().lower()
+    # Fast path: most units arrive already clean (alias keys are stripped
+    # and lowercase, so a direct hit needs no further work).
+    canonical = UNIT_ALIASES.get(unit)
+    if canonical is not None:
+        return canonical
+    unit = sys.intern(unit.strip().lower())
     return UNIT_ALIASES.get(unit, unit)
 
 
 def normalize_item(item: str) -> str:
     """Normalize an item name for deduplication."""
     item = item.strip().lower()
-    # Remove leading articles
-    item = re.sub(r"^(a |an |the |some )", "", item)
+    # Remove leading articles (cheap prefix test before running the regex)
+    if item.startswith(_ARTICLES):
+        item = _ARTICLE.sub("", item)
     # Remove trailing qualifiers in parens like "(chopped)" or "(diced)"
-    item = re.sub(r"\s*\(.*?\)\s*$", "", item)
-    return item.strip()
-
-
-def is_pantry_staple(item: str) -> bool:
-    """Check if an item is a pantry staple."""
-    return normalize_item(item) in PANTRY_STAPLES
-
+    if item.endswith(")"):
+        item = _PAREN_TAIL.sub("", item)
+    return sys.intern(item.strip())
 
-def convert_to_base(qty: float, unit: str) -> tuple[float, str]:
-    """Convert kg->g, l->ml for consistent summation."""
-    if unit in UNIT_CONVERSIONS:
-        base_unit, factor = UNIT_CONVERSIONS[unit]
-        return qty * factor, base_unit
-    return qty, unit
 
+def merge_recipe(merged: dict[str, dict], recipe: dict) -> None:
+    """Fold one recipe's ingredients into the running merged table.
 
-def consolidate(recipes: list[dict]) -> dict:
-    """Consolidate ingredients across recipes.
-
-    Returns:
-        {
-          "shopping_list": [...],
-          "pantry_staples": [...],
-          "by_recipe": {...}
-        }
+    Entries are keyed by normalized name + base unit, so callers can feed
+    recipes one at a time (e.g. while stream-parsing) and finalize later.
     """
-    # Collect all ingredients keyed by normalized name + unit
-    merged: dict[str, dict] = defaultdict(
-        lambda: {"qty": 0, "unit": "", "item": "", "sources": []}
-    )
+    pantry = PANTRY_STAPLES
+    conversions = UNIT_CONVERSIONS
+    recipe_name = recipe.get("recipe", "Unknown")
+    for ing in recipe.get("ingredients", []):
+        raw_item = ing.get("item", "")
+        raw_unit = ing.get("unit", "")
+        raw_qty = float(ing.get("qty", 0) or 0)
+
+        norm_item = normalize_item(raw_item)
+        norm_unit = normalize_unit(raw_unit)
+
+        # Convert to base units (kg->g, l->ml per UNIT_CONVERSIONS) for
+        # consistent summation
+        conversion = conversions.get(norm_unit)
+        if conversion is not None:
+            base_unit, factor = conversion
+            base_qty = raw_qty * factor
+        else:
+            base_unit = norm_unit
+            base_qty = raw_qty
+
+        key = f"{norm_item}|{base_unit}"
+        entry = merged.get(key)
+        if entry is None:
+            # norm_item is already normalized, so check membership directly
+            entry = merged[key] = {
+                "qty": 0.0,
+                "unit": base_unit,
+                "item": norm_item,
+                "sources": {},  # insertion-ordered set of recipe names
+                "pantry": norm_item in pantry,
+            }
+        entry["sources"][recipe_name] = None
+
+        if entry["pantry"]:
+            # Pantry staples: don't sum, just mark as needed
+            if base_qty > entry["qty"]:
+                entry["qty"] = base_qty
+        else:
+            # Regular items: sum quantities
+            entry["qty"] += base_qty
 
-    for recipe in recipes:
-        recipe_name = recipe.get("recipe", "Unknown")
-        for ing in recipe.get("ingredients", []):
-            raw_item = ing.get("item", "")
-            raw_unit = ing.get("unit", "")
-            raw_qty = float(ing.get("qty", 0) or 0)
-
-            norm_item = normalize_item(raw_item)
-            norm_unit = normalize_unit(raw_unit)
-
-            # Convert to base units for consistent summation
-            base_qty, base_unit = convert_to_base(raw_qty, norm_unit)
-
-            key = f"{norm_item}|{base_unit}"
-            entry = merged[key]
-            entry["item"] = norm_item
-            entry["unit"] = base_unit
-            entry["sources"].append(recipe_name)
-
-            if is_pantry_staple(norm_item):
-                # Pantry staples: don't sum, just mark as needed
-                entry["qty"] = max(entry["qty"], base_qty)
-                entry["pantry"] = True
-            else:
-                # Regular items: sum quantities
-                entry["qty"] += base_qty
 
+def finalize_merged(merged: dict[str, dict]) -> dict:
+    """Turn the merged table into the sorted shopping list / pantry split."""
     # Split into shopping list and pantry staples
     shopping_list = []
     pantry_staples = []
 
-    for entry in sorted(merged.values(), key=lambda e: e["item"]):
+    for entry in sorted(merged.values(), key=itemgetter("item")):
         result = {
             "item": entry["item"],
             "qty": round(entry["qty"], 1) if entry["qty"] else None,
             "unit": entry["unit"] if entry["unit"] else None,
-            "sources": sorted(set(entry["sources"])),
+            "sources": sorted(entry["sources"]),
         }
         # Clean up display: convert back to kg/l if large
-        if result["unit"] == "g" and result["qty"] and result["qty"] >= 1000:
-            result["qty"] = round(result["qty"] / 1000, 2)
-            result["unit"] = "kg"
-        if result["unit"] == "ml" and result["qty"] and result["qty"] >= 1000:
-            result["qty"] = round(result["qty"] / 1000, 2)
-            result["unit"] = "l"
-
-        if entry.get("pantry"):
+        rescale = DISPLAY_RESCALE.get(result["unit"])
+        if rescale and result["qty"] and result["qty"] >= rescale[1]:
+            result["unit"], factor = rescale
+            result["qty"] = round(result["qty"] / factor, 2)
+
+        if entry["pantry"]:
             pantry_staples.append(result)
         else:
             shopping_list.append(result)
@@ -253,6 +284,23 @@ def consolidate(recipes: list[dict]) -> dict:
     }
 
 
+def consolidate(recipes: Iterable[dict]) -> dict:
+    """Consolidate ingredients across recipes.
+
+    Returns:
+        {
+          "shopping_list": [...],
+          "pantry_staples": [...],
+          "by_recipe": {...}
+        }
+    """
+    # Collect all ingredients keyed by normalized name + unit
+    merged: dict[str, dict] = {}
+    for recipe in recipes:
+        merge_recipe(merged, recipe)
+    return finalize_merged(merged)
+
+
 # --- Plain text ingredient parser ---
 
 # Unit keywords (longer first to avoid partial matches like "l" eating "lemon")
@@ -286,6 +334,9 @@ def parse_qty(raw: str) -> float:
     """Parse a quantity string to float."""
     if not raw:
         return 0
+    # Fast path: plain integers are by far the most common quantity
+    if raw.isdecimal():
+        return float(raw)
     raw = raw.strip().lower()
     if raw in FRACTION_MAP:
         return FRACTION_MAP[raw]
@@ -312,10 +363,10 @@ def parse_qty(raw: str) -> float:
 def parse_ingredient_line(line: str) -> dict | None:
     """Parse a single ingredient line into structured form."""
     line = line.strip()
-    if not line or line.startswith("#") or line.startswith("//"):
+    if not line or line.startswith(("#", "//")):
         return None
     # Strip leading list markers (bullets, "1.", "2)") but preserve qty digits
-    line = re.sub(r"^(?:[\-\*\u2022]\s*|\d+[.)]\s+)", "", line).strip()
+    line = _LIST_MARKER.sub("", line).strip()
     if not line:
         return None
 
@@ -333,22 +384,55 @@ def parse_ingredient_line(line: str) -> dict | None:
 def parse_ingredients(text: str) -> list[dict]:
     """Parse a block of plain-text ingredients into structured JSON."""
     results = []
+    append = results.append
+    parse_line = parse_ingredient_line
     for line in text.splitlines():
-        parsed = parse_ingredient_line(line)
+        parsed = parse_line(line)
         if parsed:
-            results.append(parsed)
+            append(parsed)
     return results
 
 
+def _loads(data: str | bytes) -> object:
+    """Decode a recipe document, using orjson as a fast path when installed.
+
+    Anything orjson rejects (NaN, Infinity, 1e999) is retried with json.loads,
+    so whether a file is accepted never depends on orjson. Integers wider than
+    64 bits still come back as floats under orjson; quantities are coerced to
+    float regardless.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def iter_recipes(f: BinaryIO) -> Iterable[dict]:
+    """Yield recipes from a JSON array, streaming with ijson when available.
+
+    Raises ValueError if the top-level document is not an array.
+    """
+    if ijson is not None:
+        events = ijson.parse(f, use_float=True)
+        first = next(events, None)
+        if first is None or first[1] != "start_array":
+            raise ValueError("Expected a JSON array of recipes")
+        return ijson.items(itertools.chain([first], events), "item")
+    data = _loads(f.read())
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array of recipes")
+    return data
+
+
 def cmd_consolidate(args: argparse.Namespace) -> int:
     """Consolidate ingredients from multiple recipes."""
     if args.input:
-        with open(args.input) as f:
-            data = json.load(f)
+        with open(args.input, "rb") as f:
+            result = consolidate(iter_recipes(f))
     else:
-        data = json.load(sys.stdin)
-
-    result = consolidate(data)
+        result = consolidate(iter_recipes(sys.stdin.buffer))
     print(json.dumps(result, indent=2))
     return 0
 
@@ -15,10 +15,13 @@ Requires: Xvfb, x11vnc, websockify, fluxbox, google-chrome (or chromium).
 """
 
 import argparse
-import glob
+import functools
 import json
 import os
+import re
 import secrets
+import select
+import shutil
 import signal
 import socket
 import subprocess
@@ -27,6 +30,12 @@ import time
 from datetime import datetime, timezone
 from pathlib import Path
 
+# Optional: faster decoding of CDP responses and session files (see _loads).
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 SESSION_DIR = Path("/tmp")
 SESSION_PREFIX = "tesco-vnc-"
 SESSION_SUFFIX = ".json"
@@ -41,22 +50,69 @@ VM_IP = os.environ.get("TESCO_VNC_HOST", "16.60.83.110")
 # noVNC HTML path (Debian/Ubuntu default)
 NOVNC_PATH = "/usr/share/novnc"
 
+# Matches the cmdline of Xvfb servers on our display range (:100-:199)
+_XVFB_CMDLINE = re.compile(rb"Xvfb :(1[0-9][0-9])")
+
 
 def session_file(profile: str) -> Path:
     return SESSION_DIR / f"{SESSION_PREFIX}{profile}{SESSION_SUFFIX}"
 
 
+def _loads(data: str | bytes | bytearray) -> object:
+    """Parse JSON from CDP or a session file, preferring orjson.
+
+    Falls back to json.loads for documents orjson refuses (e.g. NaN), so
+    the json.JSONDecodeError handlers see the same failures either way.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def list_session_files() -> list[Path]:
+    """Return every session file in SESSION_DIR using a single directory scan."""
+    with os.scandir(SESSION_DIR) as it:
+        return [
+            Path(entry.path) for entry in it
+            if entry.name.startswith(SESSION_PREFIX)
+            and entry.name.endswith(SESSION_SUFFIX)
+            and entry.is_file()
+        ]
+
+
+@functools.lru_cache(maxsize=1)
 def find_chrome() -> str:
     """Find the Chrome/Chromium binary."""
     for name in ("google-chrome", "google-chrome-stable", "chromium-browser", "chromium"):
-        path = subprocess.run(
-            ["which", name], capture_output=True, text=True
-        ).stdout.strip()
+        path = shutil.which(name)
         if path:
             return path
     raise RuntimeError("Chrome or Chromium not found in PATH")
 
 
+def find_xvfb_pids() -> list[int]:
+    """Return pids of our Xvfb displays by scanning /proc (no pgrep fork)."""
+    own_pid = os.getpid()
+    pids = []
+    with os.scandir("/proc") as it:
+        for entry in it:
+            if not entry.name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry.name}/cmdline", "rb") as f:
+                    cmdline = f.read().replace(b"\0", b" ")
+            except OSError:
+                continue  # exited or not readable
+            if _XVFB_CMDLINE.search(cmdline):
+                pid = int(entry.name)
+                if pid != own_pid:
+                    pids.append(pid)
+    return pids
+
+
 def is_port_free(port: int) -> bool:
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         try:
@@ -66,6 +122,26 @@ def is_port_free(port: int) -> bool:
             return False
 
 
+def used_tcp_ports() -> set[int] | None:
+    """Return every locally bound TCP port from /proc, or None if unavailable."""
+    ports: set[int] = set()
+    readable = False
+    for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+        # tcp6 is absent when IPv6 is disabled; keep whatever tcp gave us
+        try:
+            with open(table) as f:
+                next(f, None)  # header
+                for line in f:
+                    local = line.split(None, 2)[1]
+                    ports.add(int(local.rsplit(":", 1)[1], 16))
+        except OSError:
+            continue
+        except (IndexError, ValueError):
+            return None
+        readable = True
+    return ports if readable else None
+
+
 def is_display_free(display_num: int) -> bool:
     lock = Path(f"/tmp/.X{display_num}-lock")
     return not lock.exists()
@@ -81,8 +157,11 @@ def allocate_display() -> int:
 
 def allocate_port() -> int:
     """Find the next free websockify port."""
+    # One read of the socket table rules out busy ports without a bind() per
+    # candidate; the bind() then only confirms the first likely-free port.
+    used = used_tcp_ports() or set()
     for p in range(WEBSOCKIFY_PORT_BASE, WEBSOCKIFY_PORT_BASE + MAX_SESSIONS):
-        if is_port_free(p):
+        if p not in used and is_port_free(p):
             return p
     raise RuntimeError("No free websockify ports available")
 
@@ -94,21 +173,108 @@ def wait_for_port(port: int, timeout: float = 10) -> bool:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             if s.connect_ex(("127.0.0.1", port)) == 0:
                 return True
-        time.sleep(0.3)
+        time.sleep(0.05)
     return False
 
 
-def kill_pid(pid: int) -> None:
-    """Send SIGTERM then SIGKILL if the process doesn't exit."""
+def is_x_display_listening(display_num: int) -> bool:
+    """Check whether an X server accepts connections on the given display.
+
+    Tries the Linux abstract socket first (Xvfb serves there even when it
+    cannot create /tmp/.X11-unix), then the filesystem socket. Connecting,
+    rather than checking the path exists, ignores stale socket files.
+    """
+    path = f"/tmp/.X11-unix/X{display_num}"
+    for address in ("\0" + path, path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(address)
+                return True
+            except OSError:
+                continue
+    return False
+
+
+def wait_for_x_display(display_num: int, xvfb: subprocess.Popen, timeout: float = 5) -> bool:
+    """Wait until Xvfb accepts connections on its display (or exits)."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if is_x_display_listening(display_num):
+            return True
+        if xvfb.poll() is not None:
+            return False
+        time.sleep(0.02)
+    return False
+
+
+def kill_pids(pids: list[int], grace: float = 1.0) -> None:
+    """SIGTERM all pids, wait for them together, then SIGKILL any stragglers.
+
+    Exits are observed via pidfds (Linux 5.3+) in a single select() call;
+    without pidfd support we fall back to one short sleep before SIGKILL.
+    """
+    pidfd_open = getattr(os, "pidfd_open", None)
+    watched: dict[int, int] = {}  # pidfd -> pid
+    unwatched: list[int] = []
+    for pid in pids:
+        fd = None
+        if pidfd_open is not None:
+            try:
+                fd = pidfd_open(pid)
+            except ProcessLookupError:
+                continue  # already dead
+            except OSError:
+                pass
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            if fd is not None:
+                os.close(fd)
+            continue
+        if fd is None:
+            unwatched.append(pid)
+        else:
+            watched[fd] = pid
+
     try:
-        os.kill(pid, signal.SIGTERM)
-        # Give it a moment to exit gracefully
-        for _ in range(10):
-            os.kill(pid, 0)  # check if alive
-            time.sleep(0.1)
-        os.kill(pid, signal.SIGKILL)
-    except ProcessLookupError:
-        pass  # already dead
+        deadline = time.monotonic() + grace
+        while watched:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            ready, _, _ = select.select(list(watched), [], [], remaining)
+            for fd in ready:
+                os.close(fd)
+                del watched[fd]
+        if unwatched:
+            time.sleep(0.2)
+        for pid in [*watched.values(), *unwatched]:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass  # exited in the meantime
+    finally:
+        for fd in watched:
+            os.close(fd)
+
+
+def raise_on_sigterm(signum: int, frame: object) -> None:
+    """Signal handler that turns SIGTERM into SystemExit."""
+    raise SystemExit(128 + signum)
+
+
+def spawn(argv: list[str], env: dict[str, str]) -> subprocess.Popen:
+    """Start a session process detached from our session, output discarded.
+
+    Children get their own session so they outlive this short-lived CLI
+    without receiving its terminal's SIGHUP/SIGINT.
+    """
+    return subprocess.Popen(
+        argv,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        env=env,
+        start_new_session=True,
+    )
 
 
 # ── Commands ────────────────────────────────────────────────────────────
@@ -118,7 +284,7 @@ def cmd_start(profile: str, cdp_port: int) -> int:
     sf = session_file(profile)
     if sf.exists():
         try:
-            existing = json.loads(sf.read_text())
+            existing = _loads(sf.read_text())
             # Check if the session is still alive
             xvfb_pid = existing.get("pids", {}).get("xvfb")
             if xvfb_pid:
@@ -151,29 +317,28 @@ def cmd_start(profile: str, cdp_port: int) -> int:
 
     pids: dict[str, int] = {}
 
+    # One environment shared by every child process
+    env = {**os.environ, "DISPLAY": display}
+
+    # Children run in their own session, so signals aimed at us no longer
+    # reach them. Turn SIGTERM into an exception until the session file is
+    # written, so the cleanup below runs instead of leaving them untracked.
+    prev_sigterm = signal.signal(signal.SIGTERM, raise_on_sigterm)
     try:
         # 1. Start Xvfb
-        xvfb = subprocess.Popen(
-            ["Xvfb", display, "-screen", "0", "1280x800x24", "-ac"],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-        )
+        xvfb = spawn(["Xvfb", display, "-screen", "0", "1280x800x24", "-ac"], env)
         pids["xvfb"] = xvfb.pid
-        time.sleep(0.5)
-
-        env = {**os.environ, "DISPLAY": display}
+        if not wait_for_x_display(display_num, xvfb):
+            raise RuntimeError(f"Xvfb did not start on display {display}")
 
         # 2. Start fluxbox (window manager)
-        fluxbox = subprocess.Popen(
-            ["fluxbox"],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-            env=env,
-        )
+        fluxbox = spawn(["fluxbox"], env)
+        # No need to wait: fluxbox adopts windows that already exist when it starts
         pids["fluxbox"] = fluxbox.pid
-        time.sleep(0.3)
 
         # 3. Launch Chrome
         chrome_bin = find_chrome()
-        chrome = subprocess.Popen(
+        chrome = spawn(
             [
                 chrome_bin,
                 f"--user-data-dir={browser_profile_dir}",
@@ -192,14 +357,12 @@ def cmd_start(profile: str, cdp_port: int) -> int:
                 "--window-position=0,0",
                 "https://www.tesco.com/groceries/en-GB/",
             ],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-            env=env,
+            env,
         )
         pids["chrome"] = chrome.pid
-        time.sleep(1)
 
         # 4. Start x11vnc
-        x11vnc = subprocess.Popen(
+        x11vnc = spawn(
             [
                 "x11vnc",
                 "-display", display,
@@ -210,7 +373,7 @@ def cmd_start(profile: str, cdp_port: int) -> int:
                 "-noxdamage",
                 "-nopw",  # disable the warning about no password file
             ],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            env,
         )
         pids["x11vnc"] = x11vnc.pid
 
@@ -218,40 +381,42 @@ def cmd_start(profile: str, cdp_port: int) -> int:
             raise RuntimeError(f"x11vnc did not start on port {vnc_port}")
 
         # 5. Start websockify
-        websockify = subprocess.Popen(
+        websockify = spawn(
             [
                 "websockify",
                 "--web", NOVNC_PATH,
                 str(ws_port),
                 f"localhost:{vnc_port}",
             ],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            env,
         )
         pids["websockify"] = websockify.pid
 
         if not wait_for_port(ws_port, timeout=5):
             raise RuntimeError(f"websockify did not start on port {ws_port}")
 
-    except Exception:
-        # Clean up any processes we started
-        for pid in pids.values():
-            kill_pid(pid)
+        url = f"http://{VM_IP}:{ws_port}/vnc.html?autoconnect=true&password={password}"
+
+        session = {
+            "profile": profile,
+            "display": display,
+            "websockify_port": ws_port,
+            "vnc_port": vnc_port,
+            "cdp_port": cdp_port,
+            "password": password,
+            "url": url,
+            "pids": pids,
+            "started_at": datetime.now(timezone.utc).isoformat(),
+        }
+        sf.write_text(json.dumps(session, indent=2))
+
+    except BaseException:
+        # Clean up any processes we started, including on Ctrl-C / SIGTERM
+        kill_pids(list(pids.values()))
+        sf.unlink(missing_ok=True)
         raise
-
-    url = f"http://{VM_IP}:{ws_port}/vnc.html?autoconnect=true&password={password}"
-
-    session = {
-        "profile": profile,
-        "display": display,
-        "websockify_port": ws_port,
-        "vnc_port": vnc_port,
-        "cdp_port": cdp_port,
-        "password": password,
-        "url": url,
-        "pids": pids,
-        "started_at": datetime.now(timezone.utc).isoformat(),
-    }
-    sf.write_text(json.dumps(session, indent=2))
+    finally:
+        signal.signal(signal.SIGTERM, prev_sigterm)
 
     print(json.dumps({
         "status": "started",
@@ -268,7 +433,7 @@ def cmd_status(profile: str) -> int:
         return 0
 
     try:
-        session = json.loads(sf.read_text())
+        session = _loads(sf.read_text())
     except json.JSONDecodeError:
         print(json.dumps({"logged_in": False, "session_active": False}))
         return 0
@@ -307,7 +472,7 @@ def check_login_via_cdp(cdp_port: int) -> bool:
         conn = http.client.HTTPConnection("127.0.0.1", cdp_port, timeout=5)
         conn.request("GET", "/json")
         resp = conn.getresponse()
-        targets = json.loads(resp.read())
+        targets = _loads(resp.read())
         conn.close()
 
         page_ws = None
@@ -355,12 +520,17 @@ def check_login_via_cdp(cdp_port: int) -> bool:
         }).encode()
 
         mask_key = secrets.token_bytes(4)
-        masked = bytes(b ^ mask_key[i % 4] for i, b in enumerate(payload))
+        # XOR the whole payload at once as big integers (C speed, stdlib only)
+        # instead of a Python-level loop over each byte.
+        plen = len(payload)
+        key_stream = (mask_key * (plen // 4 + 1))[:plen]
+        masked = (
+            int.from_bytes(payload, "big") ^ int.from_bytes(key_stream, "big")
+        ).to_bytes(plen, "big")
 
         # Build frame: FIN + TEXT opcode, MASK bit + length, mask key, masked payload
         frame = bytearray()
         frame.append(0x81)  # FIN + TEXT
-        plen = len(payload)
         if plen <= 125:
             frame.append(0x80 | plen)
         elif plen <= 65535:
@@ -374,13 +544,17 @@ def check_login_via_cdp(cdp_port: int) -> bool:
         sock.sendall(bytes(frame))
 
         # Read response frame
-        def recv_exact(n: int) -> bytes:
-            buf = b""
-            while len(buf) < n:
-                chunk = sock.recv(n - len(buf))
-                if not chunk:
+        def recv_exact(n: int) -> bytearray:
+            # Fill a preallocated buffer in place; large cookie responses
+            # would otherwise be re-copied on every chunk.
+            buf = bytearray(n)
+            view = memoryview(buf)
+            got = 0
+            while got < n:
+                read = sock.recv_into(view[got:])
+                if not read:
                     raise ConnectionError("socket closed")
-                buf += chunk
+                got += read
             return buf
 
         hdr = recv_exact(2)
@@ -393,7 +567,7 @@ def check_login_via_cdp(cdp_port: int) -> bool:
         resp_data = recv_exact(resp_len)
         sock.close()
 
-        result = json.loads(resp_data)
+        result = _loads(resp_data)
         cookies = result.get("result", {}).get("cookies", [])
         return any(c.get("name") == "OAuth.AccessToken" for c in cookies)
 
@@ -409,7 +583,7 @@ def cmd_stop(profile: str, quiet: bool = False) -> int:
         return 0
 
     try:
-        session = json.loads(sf.read_text())
+        session = _loads(sf.read_text())
     except json.JSONDecodeError:
         sf.unlink(missing_ok=True)
         if not quiet:
@@ -417,11 +591,11 @@ def cmd_stop(profile: str, quiet: bool = False) -> int:
         return 0
 
     pids = session.get("pids", {})
-    # Kill in reverse dependency order
-    for name in ("websockify", "x11vnc", "fluxbox", "chrome", "xvfb"):
-        pid = pids.get(name)
-        if pid:
-            kill_pid(pid)
+    # Signal in reverse dependency order, then wait on all of them at once
+    kill_pids([
+        pid for name in ("websockify", "x11vnc", "fluxbox", "chrome", "xvfb")
+        if (pid := pids.get(name))
+    ])
 
     sf.unlink(missing_ok=True)
     if not quiet:
@@ -433,43 +607,31 @@ def cmd_cleanup() -> int:
     now = datetime.now(timezone.utc)
     cleaned = 0
 
-    for path in glob.glob(str(SESSION_DIR / f"{SESSION_PREFIX}*{SESSION_SUFFIX}")):
-        sf = Path(path)
+    # Xvfb pids of sessions that survive cleanup, parsed once for the orphan scan
+    live_xvfb_pids: set[int] = set()
+
+    for sf in list_session_files():
         try:
-            session = json.loads(sf.read_text())
+            session = _loads(sf.read_text())
             started = datetime.fromisoformat(session["started_at"])
             age = (now - started).total_seconds()
             if age > SESSION_TTL_SECONDS:
                 profile = session.get("profile", sf.stem.removeprefix(SESSION_PREFIX))
                 cmd_stop(profile, quiet=True)
                 cleaned += 1
+            else:
+                xvfb_pid = session.get("pids", {}).get("xvfb")
+                if xvfb_pid:
+                    live_xvfb_pids.add(xvfb_pid)
         except (json.JSONDecodeError, KeyError):
             sf.unlink(missing_ok=True)
             cleaned += 1
 
     # Kill orphaned Xvfb processes that don't have a session file
     try:
-        result = subprocess.run(
-            ["pgrep", "-af", "Xvfb :(1[0-9][0-9])"],
-            capture_output=True, text=True,
-        )
-        for line in result.stdout.strip().splitlines():
-            parts = line.split()
-            if len(parts) >= 2:
-                pid = int(parts[0])
-                # Check if any session file references this PID
-                has_session = False
-                for spath in glob.glob(str(SESSION_DIR / f"{SESSION_PREFIX}*{SESSION_SUFFIX}")):
-                    try:
-                        s = json.loads(Path(spath).read_text())
-                        if s.get("pids", {}).get("xvfb") == pid:
-                            has_session = True
-                            break
-                    except (json.JSONDecodeError, KeyError):
-                        pass
-                if not has_session:
-                    kill_pid(pid)
-                    cleaned += 1
+        orphans = [pid for pid in find_xvfb_pids() if pid not in live_xvfb_pids]
+        kill_pids(orphans)
+        cleaned += len(orphans)
     except Exception:
         pass
 